@@ -1,10 +1,14 @@
-import requests
 import datetime
-import pytz
 import os
 import sys
+import collections
+import gzip
+import heapq
 import json
 import logging
+import tempfile
+import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,40 +17,186 @@ logger = logging.getLogger(__name__)
 # Constants
 QUARTER_HOUR_MINUTES = 15
 QUARTERS_PER_HOUR = 4
+CHEAPEST_QUARTER_COUNT = 3
 DEFAULT_TIMEZONE = "Europe/Helsinki"
 DEFAULT_START_HOUR = 7
 DEFAULT_END_HOUR = 21
 REQUEST_TIMEOUT = 10
-
-# Load configuration
+# "HH:MM" labels for every quarter of the day, indexed by quarter number
+QUARTER_LABELS = tuple(
+    f"{hour:02d}:{minute:02d}"
+    for hour in range(24)
+    for minute in range(0, 60, QUARTER_HOUR_MINUTES)
+)
+# Telegram report; the cheapest 1-hour block is appended when available
+REPORT_TEMPLATE = (
+    "Three Cheapest Quarters Today ({start_hour}–{end_hour}):\n"
+    "{price_lines}\n"
+    "\n"
+    "Average price today: {average:.2f} snt/kWh"
+)
+# Tolerance for comparing rolling price sums, so that float drift doesn't
+# make a later block with an equal sum win over an earlier one
+PRICE_SUM_TOLERANCE = 1e-9
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_CODES = (502, 503, 504)
+# Day-ahead prices are published around 14:00 CET the day before delivery,
+# roughly this many hours before the local day starts
+PRICE_PUBLICATION_LEAD_HOURS = 10
+CACHE_DIR = tempfile.gettempdir()
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.json")
-try:
-    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-        conf = json.load(f)
-except FileNotFoundError:
-    logger.error(f"Config file not found at {CONFIG_PATH}")
-    sys.exit(1)
-except json.JSONDecodeError as e:
-    logger.error(f"Invalid JSON in config.json: {e}")
-    sys.exit(1)
-
-TELEGRAM_BOT_TOKEN = conf.get("TELEGRAM_BOT_TOKEN")
-TELEGRAM_CHAT_ID = conf.get("TELEGRAM_CHAT_ID")
-if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-    logger.error("Missing required config: TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID")
-    sys.exit(1)
-
-TIMEZONE = conf.get("TIMEZONE", DEFAULT_TIMEZONE)
-START_HOUR = int(conf.get("START_HOUR", DEFAULT_START_HOUR))
-END_HOUR = int(conf.get("END_HOUR", DEFAULT_END_HOUR))
-
-if not 0 <= START_HOUR < 24 or not 0 <= END_HOUR <= 24 or START_HOUR >= END_HOUR:
-    logger.error(f"Invalid hours: START_HOUR={START_HOUR}, END_HOUR={END_HOUR}")
-    sys.exit(1)
+UTC = datetime.timezone.utc
+
+Config = collections.namedtuple(
+    "Config",
+    ["telegram_url", "telegram_chat_id", "tz", "start_hour", "end_hour"],
+)
+
+def load_config(path=CONFIG_PATH):
+    """Load and validate the bot configuration, exiting if it is unusable.
+    
+    Args:
+        path: Path to the JSON config file
+    
+    Returns:
+        Config with the Telegram endpoint, timezone and reporting hours
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            conf = json.load(f)
+    except FileNotFoundError:
+        logger.error(f"Config file not found at {path}")
+        sys.exit(1)
+    except json.JSONDecodeError as e:
+        logger.error(f"Invalid JSON in config.json: {e}")
+        sys.exit(1)
+
+    telegram_bot_token = conf.get("TELEGRAM_BOT_TOKEN")
+    telegram_chat_id = conf.get("TELEGRAM_CHAT_ID")
+    if not telegram_bot_token or not telegram_chat_id:
+        logger.error("Missing required config: TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID")
+        sys.exit(1)
+
+    timezone = conf.get("TIMEZONE", DEFAULT_TIMEZONE)
+    try:
+        tz = ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        logger.error(f"Invalid TIMEZONE in config.json: {e}")
+        sys.exit(1)
+
+    start_hour = int(conf.get("START_HOUR", DEFAULT_START_HOUR))
+    end_hour = int(conf.get("END_HOUR", DEFAULT_END_HOUR))
+    if not 0 <= start_hour < 24 or not 0 <= end_hour <= 24 or start_hour >= end_hour:
+        logger.error(f"Invalid hours: START_HOUR={start_hour}, END_HOUR={end_hour}")
+        sys.exit(1)
+
+    return Config(
+        telegram_url=f"https://api.telegram.org/bot{telegram_bot_token}/sendMessage",
+        telegram_chat_id=telegram_chat_id,
+        tz=tz,
+        start_hour=start_hour,
+        end_hour=end_hour,
+    )
+
+def http_request(url, params=None, data=None):
+    """Make an HTTP request and return the response body.
+    
+    GET requests are retried with backoff on connection errors and on
+    RETRY_STATUS_CODES. POSTs are sent only once so a Telegram message is
+    never delivered twice.
+    
+    Args:
+        url: Request URL
+        params: Optional dict of query string parameters
+        data: Optional dict of form fields, sent as a POST when given
+    
+    Returns:
+        Response body as bytes, gzip-decoded if needed
+    
+    Raises:
+        TimeoutError: If the request times out
+        urllib.error.URLError: If the request fails
+    """
+    # urllib.request pulls in http.client and ssl, so it is only imported
+    # once a request is actually made
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+    if data is not None:
+        data = urllib.parse.urlencode(data).encode()
+    request = urllib.request.Request(url, data=data, headers={"Accept-Encoding": "gzip"})
+    retries = RETRY_TOTAL if data is None else 0
+
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as resp:
+                body = resp.read()
+                if resp.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return body
+        except urllib.error.HTTPError as e:
+            if attempt == retries or e.code not in RETRY_STATUS_CODES:
+                raise
+            logger.warning(f"Retrying request to {request.host} after {e}")
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, TimeoutError):
+                raise TimeoutError(f"Request to {request.host} timed out") from e
+            if attempt == retries:
+                raise
+            logger.warning(f"Retrying request to {request.host} after {e}")
+        time.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
+
+def get_price_cache_path(start, end):
+    """Return the on-disk cache file path for a price period."""
+    name = "sahkotin_prices_{}_{}.json".format(
+        start.strftime("%Y%m%dT%H%M%z"), end.strftime("%Y%m%dT%H%M%z")
+    )
+    return os.path.join(CACHE_DIR, name)
+
+def load_cached_prices(start, end):
+    """Load prices for a period from the disk cache.
+    
+    Args:
+        start: UTC datetime for start of period
+        end: UTC datetime for end of period
+    
+    Returns:
+        List of price dictionaries, or None if there is no usable cache entry
+    """
+    path = get_price_cache_path(start, end)
+    if not os.path.exists(path):
+        return None
+    published = start - datetime.timedelta(hours=PRICE_PUBLICATION_LEAD_HOURS)
+    try:
+        if os.path.getmtime(path) < published.timestamp():
+            return None
+        with open(path, "rb") as f:
+            return json.loads(f.read())["prices"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable price cache {path}: {e}")
+        return None
+
+def save_cached_prices(start, end, payload):
+    """Atomically write the raw API response body for a period to the disk cache."""
+    path = get_price_cache_path(start, end)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write price cache {path}: {e}")
 
 def get_prices_from_sahkotin(start, end):
     """Fetch electricity prices from Sahkotin API.
     
+    Day-ahead prices do not change once published, so responses are cached
+    on disk and repeated runs for the same period skip the HTTP request.
+    
     Args:
         start: UTC datetime for start of period
         end: UTC datetime for end of period
@@ -54,6 +204,11 @@ def get_prices_from_sahkotin(start, end):
     Returns:
         List of price dictionaries from the API
     """
+    cached = load_cached_prices(start, end)
+    if cached is not None:
+        logger.info("Using cached electricity prices")
+        return cached
+
     params = {
         "start": start.isoformat(),
         "end": end.isoformat(),
@@ -63,142 +218,210 @@ def get_prices_from_sahkotin(start, end):
     # Returns prices every quarter hour in snt/kWh with VAT included
     url = "https://sahkotin.fi/prices"
     try:
-        resp = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
-        return resp.json()["prices"]
-    except requests.exceptions.Timeout:
+        body = http_request(url, params=params)
+    except TimeoutError:
         logger.error("Request to Sahkotin API timed out")
         raise
-    except requests.exceptions.RequestException as e:
+    except OSError as e:
         logger.error(f"Error fetching prices from Sahkotin: {e}")
         raise
 
-def filter_prices(prices, start_hour, end_hour):
-    tz = pytz.timezone(TIMEZONE)
-    today = datetime.datetime.now(tz).date()
-    filtered = []
+    # Decode the raw body once; the same bytes go to the cache as-is
+    prices = json.loads(body)["prices"]
+    # Don't cache an empty answer, the prices may just not be published yet
+    if prices:
+        save_cached_prices(start, end, body)
+    return prices
+
+def parse_utc_timestamp(value):
+    """Parse a Sahkotin timestamp such as 2025-11-03T22:00:00.000Z as a UTC datetime."""
+    return datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), tzinfo=UTC,
+    )
+
+def filter_prices(prices, start_hour, end_hour, today, tz):
+    """Keep the given day's prices between start_hour and end_hour local time.
+    
+    Args:
+        prices: List of price dictionaries from the API
+        start_hour: First local hour to include
+        end_hour: Local hour at which to stop (exclusive)
+        today: Local date to keep prices for
+        tz: Local timezone of start_hour, end_hour and today
+    
+    Returns:
+        Tuple of (times, values) parallel lists of local datetimes and prices
+    """
+    midnight = datetime.datetime.combine(today, datetime.time(0, 0), tzinfo=tz)
+    # Convert the local hour window to UTC once so rows can be compared
+    # without converting each timestamp to local time first
+    window_start = (midnight + datetime.timedelta(hours=start_hour)).astimezone(UTC)
+    window_end = (midnight + datetime.timedelta(hours=end_hour)).astimezone(UTC)
+    # UTC ISO timestamps sort as strings, so rows outside the window can be
+    # skipped without parsing. A timestamp is never shorter than these
+    # minute-precision bounds, so one that starts with window_end sorts after it.
+    first = window_start.strftime("%Y-%m-%dT%H:%M")
+    last = window_end.strftime("%Y-%m-%dT%H:%M")
+    times = []
+    values = []
     for p in prices:
-        dt = datetime.datetime.fromisoformat(p["date"].replace("Z", "+00:00"))
-        dt_local = dt.astimezone(tz)
-        if dt_local.date() == today and start_hour <= dt_local.hour < end_hour:
-            filtered.append((dt_local, p["value"]))
-    return filtered
+        if first <= p["date"] < last:
+            times.append(parse_utc_timestamp(p["date"]).astimezone(tz))
+            values.append(p["value"])
+    return times, values
 
-def send_telegram_message(text):
+def send_telegram_message(config, text):
     """Send a message via Telegram bot.
     
     Args:
+        config: Config with the Telegram endpoint and chat ID
         text: Message text to send
     
     Raises:
-        requests.exceptions.RequestException: If the request fails
+        TimeoutError: If the request times out
+        urllib.error.URLError: If the request fails
     """
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     try:
-        resp = requests.post(url, data={"chat_id": TELEGRAM_CHAT_ID, "text": text}, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
+        http_request(config.telegram_url, data={"chat_id": config.telegram_chat_id, "text": text})
         logger.info("Telegram message sent successfully")
-    except requests.exceptions.Timeout:
+    except TimeoutError:
         logger.error("Telegram API request timed out")
         raise
-    except requests.exceptions.RequestException as e:
+    except OSError as e:
         logger.error(f"Failed to send Telegram message: {e}")
         raise
 
+def format_quarter_time(dt, offset=0):
+    """Return the HH:MM label of the quarter offset quarters after a quarter-aligned datetime.
+    
+    Uses integer arithmetic on the quarter number, wrapping at midnight, so
+    no timedelta or intermediate datetime is created.
+    """
+    quarter = dt.hour * QUARTERS_PER_HOUR + dt.minute // QUARTER_HOUR_MINUTES + offset
+    return QUARTER_LABELS[quarter % len(QUARTER_LABELS)]
+
 def format_price_line(index, dt, val):
-    next_quarter = dt + datetime.timedelta(minutes=QUARTER_HOUR_MINUTES)
-    return f"{index}. {dt.strftime('%H:%M')}–{next_quarter.strftime('%H:%M')}: {val:.2f} snt/kWh"
+    return f"{index}. {format_quarter_time(dt)}–{format_quarter_time(dt, 1)}: {val:.2f} snt/kWh"
+
 
 
+PriceSummary = collections.namedtuple(
+    "PriceSummary",
+    ["cheapest_quarters", "average", "cheapest_hour_start", "cheapest_hour_average"],
+)
 
-def find_cheapest_hour(prices):
-    """Find the cheapest 1-hour block (4 quarters) in the price list.
+def summarize_prices(values):
+    """Compute the report figures from the price list in a single pass.
     
     Args:
-        prices: List of (datetime, price) tuples
+        values: List of quarter-hour prices
     
     Returns:
-        Tuple of (block, average_price) or (None, None) if not enough data
+        PriceSummary with the indices of the cheapest quarters (cheapest
+        first), the average price, and the start index and average price of
+        the cheapest 1-hour block (None if there is not enough data)
     """
-    if len(prices) < QUARTERS_PER_HOUR:
-        return None, None
+    total = 0.0
+    # The cheapest quarters seen so far as negated (value, index) pairs, so
+    # the heap top is the one to drop when a cheaper quarter turns up
+    cheapest = []
+    block_sum = 0.0
+    cheapest_block_sum = float("inf")
+    cheapest_block_start = None
 
-    cheapest_block = None
-    cheapest_avg = float("inf")
+    for i, val in enumerate(values):
+        total += val
 
-    for i in range(len(prices) - QUARTERS_PER_HOUR + 1):
-        block = prices[i:i+QUARTERS_PER_HOUR]
-        avg_price = sum(p[1] for p in block) / QUARTERS_PER_HOUR
-        if avg_price < cheapest_avg:
-            cheapest_avg = avg_price
-            cheapest_block = block
+        entry = (-val, -i)
+        if len(cheapest) < CHEAPEST_QUARTER_COUNT:
+            heapq.heappush(cheapest, entry)
+        elif entry > cheapest[0]:
+            heapq.heapreplace(cheapest, entry)
 
-    return cheapest_block, cheapest_avg
+        # Rolling sum of the last hour's quarters
+        block_sum += val
+        if i >= QUARTERS_PER_HOUR:
+            block_sum -= values[i - QUARTERS_PER_HOUR]
+        if i >= QUARTERS_PER_HOUR - 1 and block_sum < cheapest_block_sum - PRICE_SUM_TOLERANCE:
+            cheapest_block_sum = block_sum
+            cheapest_block_start = i - QUARTERS_PER_HOUR + 1
 
-def format_cheapest_hour(prices):
+    cheapest_block_avg = None
+    if cheapest_block_start is not None:
+        cheapest_block = values[cheapest_block_start:cheapest_block_start + QUARTERS_PER_HOUR]
+        cheapest_block_avg = sum(cheapest_block) / QUARTERS_PER_HOUR
+
+    return PriceSummary(
+        cheapest_quarters=[-i for _, i in sorted(cheapest, reverse=True)],
+        average=total / len(values) if values else None,
+        cheapest_hour_start=cheapest_block_start,
+        cheapest_hour_average=cheapest_block_avg,
+    )
+
+def format_cheapest_hour(times, summary):
     """Format the cheapest hour block as a readable string.
     
     Args:
-        prices: List of (datetime, price) tuples
+        times: List of local datetimes
+        summary: PriceSummary computed from the prices matching times
     
     Returns:
         Formatted string or None if no block found
     """
-    block, avg = find_cheapest_hour(prices)
-    if not block:
+    start_index = summary.cheapest_hour_start
+    avg = summary.cheapest_hour_average
+    if start_index is None:
         return None
 
-    start = block[0][0]
-    end = block[-1][0] + datetime.timedelta(minutes=QUARTER_HOUR_MINUTES)
+    start = times[start_index]
+    last = times[start_index + QUARTERS_PER_HOUR - 1]
     return "Cheapest 1-hour block: {}–{} ({:.2f} snt/kWh average)".format(
-        start.strftime("%H:%M"), end.strftime("%H:%M"), avg
+        format_quarter_time(start), format_quarter_time(last, 1), avg
     )
 
 def main():
     """Main function to fetch and report electricity prices."""
+    config = load_config()
     try:
         logger.info("Starting electricity price check")
-        tz = pytz.timezone(TIMEZONE)
-        today = datetime.datetime.now(tz).date()
-        start_local = datetime.datetime.combine(today, datetime.time(0, 0))
+        today = datetime.datetime.now(config.tz).date()
+        start_local = datetime.datetime.combine(today, datetime.time(0, 0), tzinfo=config.tz)
         end_local = start_local + datetime.timedelta(days=1)
-        start_utc = tz.localize(start_local).astimezone(pytz.utc)
-        end_utc = tz.localize(end_local).astimezone(pytz.utc)
+        start_utc = start_local.astimezone(UTC)
+        end_utc = end_local.astimezone(UTC)
 
         logger.info("Fetching electricity prices")
         prices = get_prices_from_sahkotin(start_utc, end_utc)
-        filtered = filter_prices(prices, START_HOUR, END_HOUR)
+        times, values = filter_prices(prices, config.start_hour, config.end_hour, today, config.tz)
 
-        if not filtered:
+        if not values:
             logger.warning("No electricity price data found for today")
-            send_telegram_message("No electricity price data found for today.")
+            send_telegram_message(config, "No electricity price data found for today.")
             return
 
-        # Get top 3 cheapest quarters
-        sorted_prices = sorted(filtered, key=lambda x: x[1])
-        top3 = sorted_prices[:3]
-
-        lines = ["Three Cheapest Quarters Today ({}–{}):".format(START_HOUR, END_HOUR)]
-        lines.extend(format_price_line(i, dt, val) for i, (dt, val) in enumerate(top3, start=1))
+        summary = summarize_prices(values)
 
-        avg_price = sum(price for _, price in filtered) / len(filtered)
-        lines.append("")
-        lines.append(f"Average price today: {avg_price:.2f} snt/kWh")
-        
-        cheapest_hour_text = format_cheapest_hour(filtered)
+        message = REPORT_TEMPLATE.format(
+            start_hour=config.start_hour,
+            end_hour=config.end_hour,
+            price_lines="\n".join(
+                format_price_line(i, times[j], values[j])
+                for i, j in enumerate(summary.cheapest_quarters, start=1)
+            ),
+            average=summary.average,
+        )
+        cheapest_hour_text = format_cheapest_hour(times, summary)
         if cheapest_hour_text:
-            lines.append("")
-            lines.append(cheapest_hour_text)
-
-        message = "\n".join(lines)
+            message += "\n\n" + cheapest_hour_text
         logger.info("Sending message via Telegram")
         print(message)
-        send_telegram_message(message)
+        send_telegram_message(config, message)
         logger.info("Electricity price check completed successfully")
     except Exception as e:
         logger.error(f"Error running bot: {e}", exc_info=True)
         try:
-            send_telegram_message(f"Error running bot: {e}")
+            send_telegram_message(config, f"Error running bot: {e}")
         except Exception as send_error:
             logger.error(f"Failed to send error message to Telegram: {send_error}")
 